@@ -3,21 +3,122 @@
 # A small program to run the binomial pricing algorithm
 # for option pricing
 
+import collections
+import copy
 import math as m
 import numpy as np
-
-class Stock:
-    def __init__(self, r, sigma, S_0, T, steps):
+from scipy.special import ndtr
+
+
+# Black-Scholes value of European options on a stock paying a
+# continuous dividend yield q, vectorized over all arguments, so
+# that a whole book is priced in a few array operations; is_put
+# may be an array of flags too.  With vega=True it returns
+# (value, vega), vega = dV/dsigma being the same for calls and puts.
+def black_scholes(S, K, tau, r, q, sigma, is_put=False, vega=False):
+    S, K, tau, sigma = [np.asarray(x, dtype=float) for x in (S, K, tau, sigma)]
+    sqrt_tau = np.sqrt(tau)
+    sd       = sigma * sqrt_tau
+    S_q      = S * np.exp(-q * tau)
+    K_r      = K * np.exp(-r * tau)
+    d1 = (np.log(S_q / K_r) + sd**2 / 2) / sd
+    d2 = d1 - sd
+
+    if np.ndim(is_put) == 0 and not is_put:
+        value = S_q * ndtr(d1) - K_r * ndtr(d2)
+    elif np.ndim(is_put) == 0:
+        value = K_r * ndtr(-d2) - S_q * ndtr(-d1)
+    else:
+        value = np.where(is_put, K_r * ndtr(-d2) - S_q * ndtr(-d1),
+                                 S_q * ndtr(d1) - K_r * ndtr(d2))
+
+    if not vega:
+        return value[()]
+    dV = S_q * sqrt_tau * np.exp(-d1**2 / 2) / m.sqrt(2 * m.pi)
+    return value[()], dV[()]
+
+class LatticeCache:
+    # Process-wide LRU cache of lattice parameters and spot layers,
+    # keyed on the model inputs (see Lattice.cache_key()).  Entries
+    # are dicts of attributes as returned by Lattice.prepare(); the
+    # arrays in them are shared between lattices, so they are made
+    # read-only.  The least recently used entries are dropped once
+    # there are more than max_entries of them or their arrays take
+    # more than max_bytes.
+    def __init__(self, max_bytes=256*2**20, max_entries=1024):
+        self.max_bytes   = int(max_bytes)
+        self.max_entries = int(max_entries)
+        self.clear()
+
+    def clear(self):
+        self.entries = collections.OrderedDict()
+        self.nbytes  = 0
+        self.hits    = 0
+        self.misses  = 0
+
+    def get(self, key, build):
+        if key in self.entries:
+            self.hits += 1
+            entry = self.entries.pop(key)
+            self.entries[key] = entry
+            return entry
+
+        self.misses += 1
+        entry = build()
+        for value in entry.values():
+            if isinstance(value, np.ndarray):
+                value.flags.writeable = False
+        self.entries[key] = entry
+        self.nbytes += self.size(entry)
+        while self.entries and (self.nbytes > self.max_bytes or
+                                len(self.entries) > self.max_entries):
+            old_key, old_entry = self.entries.popitem(last=False)
+            self.nbytes -= self.size(old_entry)
+        return entry
+
+    def size(self, entry):
+        return sum([value.nbytes for value in entry.values()
+                    if isinstance(value, np.ndarray)])
+
+    # (hits, misses, entries, bytes)
+    def stats(self):
+        return self.hits, self.misses, len(self.entries), self.nbytes
+
+lattice_cache = LatticeCache()
+
+
+
+class Lattice:
+    # Common part of the recombining trees an Option is priced on.
+    # A lattice has `steps` time levels, dt = T/periods() apart,
+    # and subclasses say what the nodes of each level are:
+    #
+    #   n_nodes(i)     number of nodes at level i
+    #   level(i)       their spot prices, lowest first
+    #   rollback(V, i) discounted expectation of level i+1 values,
+    #                  in place over the first n_nodes(i) entries of V
+    #
+    # With dense=False no (nodes x steps) matrix is stored:
+    # spot prices are computed level by level as needed and
+    # options keep only one time slice of values, so memory
+    # is O(steps) instead of O(steps^2).
+    branches = 2
+
+    def __init__(self, r, sigma, S_0, T, steps, dense=True):
         self.r     = float(r)
         self.sigma = float(sigma)
         self.S_0   = float(S_0)
         self.T     = float(T)
         self.steps = int(steps)
-        self.dt    = float(T) / float(steps)
-        self.S     = np.zeros( (steps, steps) )
+        self.dt    = self.T / self.periods()
+        self.dense = dense
+        if dense:
+            self.S = np.zeros( (self.width(), steps) )
+        else:
+            self.S = None
 
     def __call__(self, i, j):
-        return self.S[i,j]
+        return self.spot(i, j)
 
     def n_steps(self):
         return self.steps
@@ -28,45 +129,278 @@ class Stock:
     def delta_t(self):
         return self.dt
 
+    # number of dt periods T is divided into.  The binomial Stock
+    # keeps its original dt = T/steps, so its last level is at
+    # T - dt; subclasses whose last level is at T override this
+    # with steps-1.
+    def periods(self):
+        return self.steps
+
+    # node i of level j
+    def spot(self, i, j):
+        if self.S is None:
+            return self.level(j)[i]
+        return self.S[i,j]
+
+    # nodes at the last level
+    def width(self):
+        return self.n_nodes(self.steps-1)
+
+    # the stock needs some way to evolve...
+    def create_tree(self):
+        key = self.cache_key()
+        if key is None:
+            params = self.prepare()
+        else:
+            params = lattice_cache.get(key, self.prepare)
+        for name in params:
+            setattr(self, name, params[name])
+
+        if self.S is not None:
+            for i in range(self.steps):
+                self.S[:self.n_nodes(i),i] = self.level(i)
+
+    # to be overridden in subclasses: precompute whatever
+    # level() and rollback() need, returned as a dict of
+    # attributes to set, including the last level as
+    # 'terminal_spots'
+    def prepare(self):
+        return {}
+
+    # key into lattice_cache; None for scenario arrays,
+    # which are not cached
+    def cache_key(self):
+        if np.ndim(self.r) > 0 or np.ndim(self.sigma) > 0:
+            return None
+        return (self.__class__.__name__, self.r, self.sigma,
+                self.S_0, self.T, self.steps) + self.key_extra()
+
+    # further parameters the tree depends on
+    def key_extra(self):
+        return ()
+
+    # the same lattice with another number of steps, rolling mode
+    def resized(self, steps):
+        L = copy.copy(self)
+        L.steps = int(steps)
+        L.dt    = self.T / L.periods()
+        L.dense = False
+        L.S     = None
+        L.create_tree()
+        return L
+
+    # the same lattice on a tree with twice as many steps
+    def refine(self):
+        return self.resized(2*self.steps)
+
+    # A rolling copy of this lattice in which sigma and r are arrays,
+    # one entry per scenario.  They are shaped (scenarios, 1, 1) so
+    # that a tree built on it carries a leading scenario axis in
+    # front of whatever axes the option itself has.
+    def scenarios(self, sigma, r):
+        L = copy.copy(self)
+        L.sigma = np.asarray(sigma, dtype=float).reshape(-1,1,1)
+        L.r     = np.asarray(r, dtype=float).reshape(-1,1,1)
+        L.dense = False
+        L.S     = None
+        L.create_tree()
+        return L
+
+
+
+class Stock(Lattice):
+    # The binomial tree with u*d = 1 and the up factor chosen
+    # through beta to match the variance of the stock.
     def spot(self, i, j):
+        # i counts the up moves, j the time level
+        if self.S is None:
+            return self.S_0 * self.up()**i * self.down()**(j-i)
         return self.S[i,j]
 
+    def n_nodes(self, i):
+        return i+1
+
+    # np rather than math functions, so that r and sigma
+    # may also be arrays of scenarios (see scenarios())
     def beta(self):
-        e_minus_rdt = m.exp(-self.r * self.dt)
+        e_minus_rdt = np.exp(-self.r * self.dt)
         e_rdt       = 1/e_minus_rdt
-        e_sigma2dt  = m.exp( (self.sigma**2) * self.dt )
+        e_sigma2dt  = np.exp( (self.sigma**2) * self.dt )
         return (e_minus_rdt + e_rdt*e_sigma2dt) / 2
 
     def up(self):
         b = self.beta()
-        return b + m.sqrt(b**2 - 1)
+        return b + np.sqrt(b**2 - 1)
 
     def down(self):
         b = self.beta()
-        return b - m.sqrt(b**2 - 1)
+        return b - np.sqrt(b**2 - 1)
 
     def p(self):
-        e_rdt = m.exp(self.r * self.dt)
-        u = self.up()
-        d = self.down()
+        e_rdt = np.exp(self.r * self.dt)
+        b = self.beta()
+        u = b + np.sqrt(b**2 - 1)
+        d = b - np.sqrt(b**2 - 1)
         return (e_rdt - d)/(u - d)
-    
-    # the stock needs some way to evolve...
-    def create_tree(self):
+
+    def prepare(self):
+        # powers of u and d for every level, so that
+        # a whole level is one array expression
+        k = np.arange(self.steps)
         u = self.up()
         d = self.down()
-        for i in range(self.steps):
-            for j in range(i):
-                k = i - j
-                self.S[j,i] = self.S_0 * u**j * d**k
-        
+        p = self.p()
+        e_minus_rdt = np.exp(-self.r * self.dt)
+        params = {'u_powers': u**k,
+                  'd_powers': d**k,
+                  # weights of the down and up move in rollback()
+                  'weights':  (e_minus_rdt*(1-p), e_minus_rdt*p)}
+        params['terminal_spots'] = self.S_0 * params['u_powers'] * params['d_powers'][...,::-1]
+        return params
+
+    # spot prices of the i+1 reachable nodes at time level i,
+    # S_0 u^j d^(i-j) for j = 0..i; requires create_tree()
+    def level(self, i):
+        if i == self.steps-1:
+            return self.terminal_spots
+        return self.S_0 * self.u_powers[...,:i+1] * self.d_powers[...,i::-1]
+
+    # discounted expectation of the values V at level i+1,
+    # written in place over the first i+1 entries of V
+    def rollback(self, V, i):
+        w_down, w_up = self.weights
+        up_moves = w_up * V[...,1:i+2]
+        V[...,:i+1] *= w_down
+        V[...,:i+1] += up_moves
+
+
+
+class LeisenReimer(Stock):
+    # Leisen-Reimer binomial tree: p and u come from the
+    # Peizer-Pratt inversion of d2 and d1, which centres the
+    # tree on the strike.  Error falls like 1/N^2 without
+    # oscillation, but the tree depends on the strike and the
+    # number of periods (steps-1) must be odd.  The last of the
+    # steps levels is at T.
+    def __init__(self, r, sigma, S_0, T, steps, strike, dense=True):
+        if int(steps) % 2:
+            raise ValueError("LeisenReimer: steps = %d, needs an odd number of periods" % steps)
+        Stock.__init__(self, r, sigma, S_0, T, steps, dense)
+        self.strike = float(strike)
+
+    def periods(self):
+        return self.steps - 1
+
+    def d1_d2(self):
+        tau = self.T
+        d1  = np.log(self.S_0/self.strike) + (self.r + self.sigma**2/2)*tau
+        d1 /= self.sigma * np.sqrt(tau)
+        return d1, d1 - self.sigma*np.sqrt(tau)
+
+    # Peizer-Pratt method 2 approximation of the normal cdf
+    def peizer_pratt(self, z):
+        n = self.steps - 1
+        x = z / (n + 1.0/3 + 0.1/(n + 1))
+        return 0.5 + np.sign(z) * np.sqrt(0.25 - 0.25*np.exp(-x**2 * (n + 1.0/6)))
+
+    def p(self):
+        d1, d2 = self.d1_d2()
+        return self.peizer_pratt(d2)
+
+    def up(self):
+        d1, d2 = self.d1_d2()
+        return np.exp(self.r * self.dt) * self.peizer_pratt(d1) / self.peizer_pratt(d2)
+
+    def down(self):
+        p = self.p()
+        return (np.exp(self.r * self.dt) - p*self.up()) / (1 - p)
+
+    def resized(self, steps):
+        # keep an odd number of periods
+        return Stock.resized(self, int(steps) + int(steps) % 2)
+
+    def key_extra(self):
+        return (self.strike,)
+
+
+
+class Trinomial(Lattice):
+    # Kamrad-Ritchken trinomial tree: from each node the stock
+    # moves to S u, S or S/u with u = exp(lambda sigma sqrt(dt)).
+    # Level i has 2i+1 nodes, S_0 u^(j-i) for j = 0..2i.
+    # lambda = sqrt(3/2) gives the middle branch probability 1/3;
+    # lambda = 1 reduces to a binomial tree.  The last of the
+    # steps levels is at T.
+    branches = 3
+
+    def __init__(self, r, sigma, S_0, T, steps, dense=True, stretch=m.sqrt(1.5)):
+        self.stretch = float(stretch)
+        Lattice.__init__(self, r, sigma, S_0, T, steps, dense)
+
+    def n_nodes(self, i):
+        return 2*i+1
+
+    def periods(self):
+        return self.steps - 1
+
+    def up(self):
+        return np.exp(self.stretch * self.sigma * np.sqrt(self.dt))
+
+    # probabilities of moving up, staying, moving down
+    def probabilities(self):
+        lam   = self.stretch
+        drift = (self.r - self.sigma**2/2) * np.sqrt(self.dt) / (2*lam*self.sigma)
+        p_up   = 1/(2*lam**2) + drift
+        p_mid  = 1 - 1/lam**2
+        p_down = 1/(2*lam**2) - drift
+        return p_up, p_mid, p_down
+
+    def key_extra(self):
+        return (self.stretch,)
+
+    def prepare(self):
+        # u^k for k = -(steps-1)..(steps-1)
+        k = np.arange(-(self.steps-1), self.steps)
+        e_minus_rdt = np.exp(-self.r * self.dt)
+        p_up, p_mid, p_down = self.probabilities()
+        params = {'powers':  self.up()**k,
+                  # weights of the down, middle and up move in rollback()
+                  'weights': (e_minus_rdt*p_down, e_minus_rdt*p_mid, e_minus_rdt*p_up)}
+        params['terminal_spots'] = self.S_0 * params['powers']
+        return params
+
+    def level(self, i):
+        if i == self.steps-1:
+            return self.terminal_spots
+        centre = self.steps - 1
+        return self.S_0 * self.powers[...,centre-i:centre+i+1]
+
+    def rollback(self, V, i):
+        w_down, w_mid, w_up = self.weights
+        n = 2*i+1
+        up_moves  = w_up  * V[...,2:n+2]
+        mid_moves = w_mid * V[...,1:n+1]
+        V[...,:n] *= w_down
+        V[...,:n] += mid_moves
+        V[...,:n] += up_moves
+
 
 
 class Option:
     def __init__(self, strike, underlying):
         self.strike = strike
         self.underlying = underlying
-        self.V = np.zeros( (self.underlying.steps, self.underlying.steps) )
+        self.dense = underlying.dense
+        self.first_levels = [None, None, None]
+        # smooth=True values the last step with Black-Scholes
+        # instead of rolling back the terminal payoff
+        self.smooth = False
+        if self.dense:
+            self.V = np.zeros( (self.underlying.width(), self.underlying.steps) )
+        else:
+            # a single time slice, overwritten in place
+            # as we step backwards through the tree
+            self.V = np.zeros(self.underlying.width())
 
     def __call__(self, i, j):
         return self.V[i,j]
@@ -81,7 +415,114 @@ class Option:
         return self.underlying.delta_t()
 
     def fair_price(self):
-        return self.V[0,0]
+        if self.dense:
+            return self.V[0,0]
+        return self.V[...,0][()]
+
+    # payoff for an array of spot prices
+    def intrinsic(self, S):
+        if self.is_put:
+            return np.maximum(self.strike - S, 0)
+        else:
+            return np.maximum(S - self.strike, 0)
+
+    # hook applied after each backward step;
+    # European options just keep the continuation value
+    def early_exercise(self, V, i):
+        pass
+
+    # evolve backwards, one whole time level per array operation,
+    # touching only the reachable nodes of each level
+    def create_tree(self):
+        V, top = self.terminal()
+        for i in range(top-1, -1, -1):
+            self.underlying.rollback(V, i)
+            self.early_exercise(V, i)
+            self.store(V, i)
+
+    # values at the last level the backward sweep starts from,
+    # returns (V, level)
+    def terminal(self):
+        S   = self.underlying
+        top = self.n_steps() - 1
+        V   = self.intrinsic(S.level(top))
+        self.store(V, top)
+
+        if self.smooth:
+            top -= 1
+            V = black_scholes(S.level(top), self.strike, S.delta_t(),
+                              S.r, 0.0, S.sigma, self.is_put)
+            self.early_exercise(V, top)
+            self.store(V, top)
+
+        if not self.dense:
+            self.V = V
+        return V, top
+
+    # copy level i into the dense tree, if we keep one;
+    # the first three levels are always kept for greeks()
+    def store(self, V, i):
+        n = self.underlying.n_nodes(i)
+        if self.dense:
+            self.V[:n,i] = V[:n]
+        if i < 3:
+            self.first_levels[i] = V[...,:n].copy()
+
+    # Delta, gamma and theta from the first levels of the last
+    # create_tree(), needs at least 3 steps.  Returns
+    # (price, delta, gamma, theta).
+    def greeks(self):
+        S  = self.underlying
+        dt = S.delta_t()
+        V0, V1 = self.first_levels[:2]
+        S1     = S.level(1)
+
+        # first level with three nodes:
+        # 2 on a binomial tree, 1 on a trinomial one
+        g  = 4 - S.branches
+        Vg = self.first_levels[g]
+        Sg = S.level(g)
+
+        delta  = (V1[...,-1] - V1[...,0]) / (S1[...,-1] - S1[...,0])
+
+        delta_up   = (Vg[...,2] - Vg[...,1]) / (Sg[...,2] - Sg[...,1])
+        delta_down = (Vg[...,1] - Vg[...,0]) / (Sg[...,1] - Sg[...,0])
+        gamma      = (delta_up - delta_down) / ((Sg[...,2] - Sg[...,0]) / 2)
+
+        # the middle node of level g is only back at S_0 when u*d = 1
+        # (not on Leisen-Reimer), so Taylor-shift its value to S_0
+        # with the delta and gamma at that level before differencing
+        dS      = Sg[...,1] - S.S_0
+        delta_g = (Vg[...,2] - Vg[...,0]) / (Sg[...,2] - Sg[...,0])
+        V_mid   = Vg[...,1] - delta_g*dS - gamma*dS**2 / 2
+        theta   = (V_mid - V0[...,0]) / (g*dt)
+
+        return V0[...,0][()], delta, gamma, theta
+
+    # Vega and rho by central differences, all four bumped
+    # trees priced in a single sweep.  Returns (vega, rho).
+    def vega_rho(self, d_sigma=0.01, d_r=0.001):
+        S = self.underlying
+        sigma = [S.sigma + d_sigma, S.sigma - d_sigma, S.sigma, S.sigma]
+        r     = [S.r, S.r, S.r + d_r, S.r - d_r]
+
+        bumped = self.copy_on(S.scenarios(sigma, r))
+        bumped.create_tree()
+        V = bumped.V[...,0].reshape(4, -1)
+
+        vega = (V[0] - V[1]) / (2*d_sigma)
+        rho  = (V[2] - V[3]) / (2*d_r)
+        if np.ndim(self.strike) == 0:
+            return vega[0], rho[0]
+        return vega, rho
+
+    # an unpriced copy of this option on another (rolling) stock
+    def copy_on(self, underlying):
+        other = copy.copy(self)
+        other.underlying   = underlying
+        other.dense        = False
+        other.first_levels = [None, None, None]
+        return other
 
 
 
@@ -89,29 +530,6 @@ class European(Option):
     def __init__(self, strike, underlying, is_put=True):
         Option.__init__(self, strike, underlying)
         self.is_put = is_put
-    
-    def payoff(self, j):
-        # calculate the payout
-        # depending on the price of the underlying
-        if self.is_put:
-            # put option
-            return max([self.strike - self.underlying(j, self.underlying.n_steps()-1), 0])
-        else:
-            # call option
-            return max([self.underlying(j, self.underlying.n_steps()-1) - self.strike, 0])
-    
-    # evolve backwards
-    def create_tree(self):
-        n_steps = self.n_steps()
-        e_minus_rdt = m.exp(-self.rate() * self.delta_t())
-        p = self.underlying.p()
-        
-        for j in range(n_steps):
-            self.V[j, n_steps-1] = self.payoff(j)
-        
-        for j in range(n_steps-2, -1, -1):
-            for i in range(n_steps-2, -1, -1):
-                self.V[j,i] = e_minus_rdt * ( p*self.V[j+1,i+1] + (1-p)*self.V[j,i+1] )
 
 
 
@@ -119,32 +537,216 @@ class American(Option):
     def __init__(self, strike, underlying, is_put=True):
         Option.__init__(self, strike, underlying)
         self.is_put = is_put
-    
-    def payoff(self, j):
-        # calculate the payout
-        # depending on the price of the underlying
+
+    # take the larger of holding on and exercising now
+    def early_exercise(self, V, i):
+        n = self.underlying.n_nodes(i)
+        np.maximum(V[...,:n], self.intrinsic(self.underlying.level(i)), out=V[...,:n])
+
+    # Evolve backwards tracking the early exercise boundary.
+    # The exercise region of a put is the block of nodes
+    # j <= b at the bottom of each level, that of a call the
+    # block j >= c at the top, and going back one level b can
+    # only fall (c only rise by at most one).  So each level
+    # walks the boundary from where it was, node by node,
+    # computes the continuation value only for the nodes held,
+    # and writes the intrinsic value in bulk for the rest.
+    # The critical spot prices end up in self.boundary (nan
+    # where no node is exercised).
+    #
+    # Trinomial trees and batches (arrays of strikes or
+    # scenarios) fall back to the plain sweep of Option.create_tree().
+    def create_tree(self):
+        S = self.underlying
+        if S.branches != 2 or np.ndim(self.strike) > 0 or np.ndim(S.sigma) > 0 or np.ndim(S.r) > 0:
+            self.boundary = None
+            Option.create_tree(self)
+            return
+
+        V, top = self.terminal()
+        K   = self.strike
+        S_0 = S.S_0
+        u_powers, d_powers = S.u_powers, S.d_powers
+        pd, pu = S.weights
+
+        self.boundary = np.empty(self.n_steps())
+        self.boundary.fill(np.nan)
+
+        spots = S.level(top)
+        exercise  = self.intrinsic(spots)
+        exercised = np.nonzero((exercise > 0) & (exercise >= V[:top+1]))[0]
         if self.is_put:
-            # put option
-            return max([self.strike - self.underlying(j, self.underlying.n_steps()-1), 0])
+            b = exercised[-1] if len(exercised) else -1
+            if b >= 0:
+                self.boundary[top] = spots[b]
         else:
-            # call option
-            return max([self.underlying(j, self.underlying.n_steps()-1) - self.strike, 0])
-            
-    
-    # evolve backwards
+            b = exercised[0] if len(exercised) else top+1
+            if b <= top:
+                self.boundary[top] = spots[b]
+
+        for i in range(top-1, -1, -1):
+            held = []
+            if self.is_put:
+                start = min(b, i)
+                b = start
+                while b >= 0:
+                    spot = S_0 * u_powers[b] * d_powers[i-b]
+                    continuation = pd*V[b] + pu*V[b+1]
+                    if K - spot > 0 and K - spot >= continuation:
+                        break
+                    held.append(continuation)
+                    b -= 1
+
+                up_moves = pu * V[start+2:i+2]
+                V[start+1:i+1] *= pd
+                V[start+1:i+1] += up_moves
+                V[b+1:start+1] = held[::-1]
+                if b >= 0:
+                    spots = S_0 * u_powers[:b+1] * d_powers[i-b:i+1][::-1]
+                    V[:b+1] = K - spots
+                    self.boundary[i] = spots[-1]
+            else:
+                start = max(b-1, 0)
+                b = start
+                while b <= i:
+                    spot = S_0 * u_powers[b] * d_powers[i-b]
+                    continuation = pd*V[b] + pu*V[b+1]
+                    if spot - K > 0 and spot - K >= continuation:
+                        break
+                    held.append(continuation)
+                    b += 1
+
+                up_moves = pu * V[1:start+1]
+                V[:start] *= pd
+                V[:start] += up_moves
+                V[start:b] = held
+                if b <= i:
+                    spots = S_0 * u_powers[b:i+1] * d_powers[i-b::-1]
+                    V[b:i+1] = spots - K
+                    self.boundary[i] = spots[0]
+
+            self.store(V, i)
+
+
+
+class Chain(Option):
+    # A whole option chain on one underlying: strikes and is_put
+    # are arrays (is_put may also be a single flag), and each
+    # backward step advances every contract at once on a
+    # (strikes x nodes) slice.  Always works in the rolling mode,
+    # whatever the underlying keeps.
+    def __init__(self, strikes, underlying, is_put=True, american=False):
+        strikes = np.asarray(strikes, dtype=float)
+        self.strike     = strikes[:,np.newaxis]
+        self.underlying = underlying
+        self.is_put     = np.broadcast_to(is_put, strikes.shape)[:,np.newaxis]
+        self.american   = american
+        self.dense      = False
+        self.smooth     = False
+        self.V          = np.zeros( (len(strikes), underlying.width()) )
+        self.first_levels = [None, None, None]
+
+    def intrinsic(self, S):
+        return np.maximum(np.where(self.is_put, self.strike - S, S - self.strike), 0)
+
+    def early_exercise(self, V, i):
+        if self.american:
+            n = self.underlying.n_nodes(i)
+            np.maximum(V[...,:n], self.intrinsic(self.underlying.level(i)), out=V[...,:n])
+
+    # fair prices of all contracts, in the order given
+    def fair_price(self):
+        return self.V[:,0].copy()
+
+
+
+class Richardson:
+    # Binomial Black-Scholes with Richardson extrapolation (BBSR):
+    # the option is priced on smoothed trees with N and 2N steps,
+    # whose error is close to c/N, and the extrapolation
+    #
+    #   V = 2 V(2N) - V(N)
+    #
+    # removes that leading term.  Works for any Option, Chain included.
+    def __init__(self, option):
+        self.coarse = option.copy_on(option.underlying)
+        self.fine   = option.copy_on(option.underlying.refine())
+        self.coarse.smooth = True
+        self.fine.smooth   = True
+
     def create_tree(self):
-        n_steps = self.n_steps()
-        e_minus_rdt = m.exp(-self.rate() * self.delta_t())
-        p = self.underlying.p()
-        
-        for j in range(n_steps):
-            self.V[j, n_steps-1] = self.payoff(j)
-        
-        for j in range(n_steps-2, -1, -1):
-            for i in range(n_steps-2, -1, -1):
-                early_exercise   = max([self.underlying(j,i) - self.strike, 0])
-                calculated_value = e_minus_rdt * ( p*self.V[j+1,i+1] + (1-p)*self.V[j,i+1] )
-                self.V[j,i]      = max([early_exercise, calculated_value])
+        self.coarse.create_tree()
+        self.fine.create_tree()
+
+    def fair_price(self):
+        return 2*self.fine.fair_price() - self.coarse.fair_price()
+
+    # |V(2N) - V(N)|, about the error of the finer tree; that of
+    # the extrapolated price is usually, not always, smaller
+    def error(self):
+        return abs(self.fine.fair_price() - self.coarse.fair_price())
+
+
+
+# step counts that met a tolerance, by (tolerance, option type,
+# lattice type, put/call, sigma*sqrt(T) bucket, log-moneyness bucket)
+step_cache = {}
+
+def step_bucket(option, tol):
+    S = option.underlying
+    vol_time  = S.sigma * m.sqrt(S.T)
+    moneyness = m.log(S.S_0 / float(np.mean(option.strike)))
+    return (tol, type(option).__name__, type(S).__name__,
+            tuple(np.unique(option.is_put).tolist()),
+            int(round(vol_time / 0.05)), int(round(moneyness / 0.05)))
+
+def auto_price(option, tol=1.0E-4, steps=16, max_steps=2**16):
+    """Price option aiming at an error of tol, with as few steps
+    as that seems to take.
+
+    Smoothed trees with N, 2N, 4N, ... steps are priced in turn and
+    every consecutive pair gives a Richardson estimate.  Doubling stops
+    once three successive estimates agree to tol, i.e. the last two
+    differences are both below it; one small difference alone is often
+    a crossing of the error through zero.  The error reported is the
+    larger of those two differences.  It is an estimate, not a bound:
+    the convergence of the smoothed trees is not monotone, and the
+    true error can still exceed it.  The starting N is remembered per
+    bucket of step_bucket(), so a repeated request starts at the
+    resolution that worked last time.
+
+    Returns (price, steps, error), with steps the finest tree used;
+    error is above tol when max_steps was reached first.
+    """
+
+    S = option.underlying
+    bucket = step_bucket(option, tol)
+    N = step_cache.get(bucket, steps)
+
+    def smoothed(n):
+        V = option.copy_on(S.resized(n))
+        V.smooth = True
+        V.create_tree()
+        return V.fair_price()
+
+    coarse = smoothed(N)
+    fine   = smoothed(2*N)
+    price  = 2*fine - coarse
+    n      = 2*N
+    errors = []
+    while True:
+        coarse = fine
+        fine   = smoothed(2*n)
+        last, price = price, 2*fine - coarse
+        errors.append(np.max(np.abs(price - last)))
+        error  = max(errors[-2:])
+        n     *= 2
+        if (len(errors) > 1 and error < tol) or 2*n > max_steps:
+            break
+
+    # starting here next time gives the same last three estimates
+    step_cache[bucket] = n // 8
+    return price, n, error
 
 
 
@@ -154,6 +756,10 @@ if __name__ == '__main__':
     import sys
 
     visual   = False
+    dense    = True
+    bbsr     = False
+    tol      = None
+    lattice  = 'crr'
     american = False
     put      = False
     total_t  = 1
@@ -169,6 +775,16 @@ if __name__ == '__main__':
 
         if option == '-v':
             visual = True
+        elif option == '-lowmem':
+            dense = False
+        elif option == '-lattice':
+            lattice = sys.argv[1]
+            del sys.argv[1]
+        elif option == '-bbsr':
+            bbsr = True
+        elif option == '-tol':
+            tol = float(sys.argv[1])
+            del sys.argv[1]
         elif option == '-am':
             american = True
         elif option == '-p':
@@ -192,12 +808,18 @@ if __name__ == '__main__':
             strike = float(sys.argv[1])
             del sys.argv[1]
         else:
-            print sys.argv[0], ': Invalid option', option
+            print(sys.argv[0], ': Invalid option', option)
             sys.exit(1)
     
         
 
-    S = Stock(rate, sigma, S_zero, total_t, n_steps)
+    # the plot needs the whole tree
+    if lattice == 'lr':
+        S = LeisenReimer(rate, sigma, S_zero, total_t, n_steps, strike, dense or visual)
+    elif lattice == 'tri':
+        S = Trinomial(rate, sigma, S_zero, total_t, n_steps, dense or visual)
+    else:
+        S = Stock(rate, sigma, S_zero, total_t, n_steps, dense or visual)
     S.create_tree()
 
     if american:
@@ -206,6 +828,10 @@ if __name__ == '__main__':
         V = European(strike, S, put)
 
     V.create_tree()
+
+    if bbsr:
+        R = Richardson(V)
+        R.create_tree()
     
     outstr = ""
     if american:
@@ -219,9 +845,14 @@ if __name__ == '__main__':
         outstr += " call"
 
     outstr += " option with"
-    print outstr
-    print "\tr = %f\n\tsigma = %f\n\tS_0 = %f\n\tK = %f" %(rate,sigma,S_zero,strike)
-    print "Fair option price V[0,0] = %f" % V.fair_price()
+    print(outstr)
+    print("\tr = %f\n\tsigma = %f\n\tS_0 = %f\n\tK = %f" %(rate,sigma,S_zero,strike))
+    print("Fair option price V[0,0] = %f" % V.fair_price())
+    if bbsr:
+        print("BBSR price = %f (error estimate %g)" % (R.fair_price(), R.error()))
+    if tol is not None:
+        price, used, error = auto_price(V, tol)
+        print("Auto price for tol %g = %f (%d steps, error estimate %g)" % (tol, price, used, error))
 
     if visual:
         times = np.linspace(0, total_t, n_steps)
@@ -233,7 +864,7 @@ if __name__ == '__main__':
         y = []
         z = []
         for i in range(len(times)):
-            for j in range(n_steps):
+            for j in range(S.width()):
                 if S(j,i) != 0:
                     x.append(times[i])
                     y.append(S(j,i))
@@ -21,6 +21,7 @@ def b(y, t):
 n_steps = 100
 delta_t = 0.01
 x_0     = 0.5
+seed    = None
 
 while len(sys.argv) > 1:
     option = sys.argv[1]
@@ -35,10 +36,16 @@ while len(sys.argv) > 1:
     elif option == '-x':
         x_0 == float(sys.argv[1])
         del sys.argv[1]
+    elif option == '-seed':
+        seed = int(sys.argv[1])
+        del sys.argv[1]
     else:
-        print sys.argv[0], ': Invalid option', option
+        print(sys.argv[0], ': Invalid option', option)
         sys.exit(1)
 
+# a fixed -seed replays the same path
+rng = np.random.default_rng(seed)
+
 t        = np.linspace(0, n_steps * delta_t, n_steps)
 y        = np.zeros(n_steps)
 y_bar    = np.zeros(n_steps)
@@ -47,7 +54,7 @@ y_bar[0] = x_0
 
 for i in range(n_steps-1):
     dt         = delta_t
-    Z          = np.random.normal(0,1)
+    Z          = rng.normal(0,1)
     dW         = Z * m.sqrt(dt)
     y[i+1]     = y[i] + a(y[i],t[i]) * dt + b(y[i],t[i]) * dW
     y_bar[i+1] = y_bar[i] + a(y_bar[i],t[i]) * dt
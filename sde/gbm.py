@@ -1,62 +1,431 @@
 #!/usr/bin/env python
 
 import math as m
+import multiprocessing
 import numpy as np
+from scipy.special import ndtri
+
+# The source of random numbers: rng if given (a numpy
+# Generator, e.g. np.random.default_rng(seed)), else the
+# global np.random state.  Everything random below takes
+# an rng, so that a run can be replayed from its seed.
+def generator(rng=None):
+    if rng is None:
+        return np.random
+    return rng
+
+# standard normal draws of the given shape; with antithetic,
+# the second half of the rows (paths) mirrors the first,
+# Z[h+k] = -Z[k], so that paths k and h+k are a pair
+def normal_draws(shape, antithetic=False, rng=None):
+    rng = generator(rng)
+    if not antithetic or len(shape) < 2:
+        return rng.normal(0, 1, shape)
+    if shape[0] % 2:
+        raise ValueError("antithetic draws need an even number of paths, got %d" % shape[0])
+    Z = rng.normal(0, 1, (shape[0]//2,) + tuple(shape[1:]))
+    return np.concatenate((Z, -Z))
+
+# A scrambled Sobol sequence in dims dimensions; successive
+# calls to its random() continue the same sequence.  scipy.stats.qmc
+# (scipy 1.7+) is only imported here, when Sobol points are asked for.
+def sobol_engine(dims, rng=None):
+    from scipy.stats import qmc
+    if rng is None:
+        seed = np.random.randint(2**31)
+    else:
+        seed = rng
+    return qmc.Sobol(d=dims, scramble=True, seed=seed)
+
+# Standard normals from a scrambled Sobol sequence, shape
+# (paths, dims): point k of the sequence mapped through the
+# inverse normal cdf.  Powers of two for paths keep the
+# balance properties of the sequence.  A sobol engine from
+# sobol_engine() may be passed to carry on its sequence.
+def sobol_normals(paths, dims, rng=None, sobol=None):
+    if sobol is None:
+        sobol = sobol_engine(dims, rng)
+    U = sobol.random(paths)
+    return ndtri(np.clip(U, 1.0E-16, 1 - 1.0E-16))
+
+# The order in which a Brownian bridge fills in W(t_1..t_n),
+# t_k = k dt: W(t_n) first, then the midpoints of ever finer
+# intervals.  Each entry (k, l, r, w_l, w_r, sd) sets
+#
+#   W_k = w_l W_l + w_r W_r + sd Z,
+#
+# with W_0 = 0 and the normal Z taken in the same order.
+def bridge_plan(n, dt):
+    plan  = [(n, 0, 0, 0.0, 0.0, m.sqrt(n*dt))]
+    queue = [(0, n)]
+    while queue:
+        l, r = queue.pop(0)
+        if r - l < 2:
+            continue
+        k = (l + r)//2
+        plan.append((k, l, r, float(r-k)/(r-l), float(k-l)/(r-l),
+                     m.sqrt(dt * (k-l)*(r-k) / float(r-l))))
+        queue.append((l, k))
+        queue.append((k, r))
+    return plan
+
+def brownian_bridge(Z, dt):
+    """Wiener paths W(t_1..t_n) from normals Z of shape (paths, n)
+    taken in Brownian bridge order (see bridge_plan()).
+
+    The first columns of Z set the coarse shape of the path, so
+    with low-discrepancy points they carry most of the variance.
+    """
+
+    n = Z.shape[-1]
+    W = np.zeros(Z.shape[:-1] + (n+1,))
+    for column, (k, l, r, w_l, w_r, sd) in enumerate(bridge_plan(n, dt)):
+        W[...,k] = w_l * W[...,l] + w_r * W[...,r] + sd * Z[...,column]
+    return W[...,1:]
 
 class Process:
-    def __init__(self, n_steps, total_t, X_0=0.0):
+    # paths > 1 simulates that many paths at once:
+    # X then has shape (paths, n_steps), one row per path,
+    # and X[...,i] is the state of every path at step i.
+    # It is stored column-major, so that each time step
+    # (a column) is contiguous in memory.
+    #
+    # store = 'file.npy' keeps X on disk instead, as a memory
+    # mapped .npy array of shape (paths, n_steps), so that runs
+    # larger than memory stream to disk; the schemes below then
+    # work through it block_size numbers (rows of paths) at a
+    # time.  load_paths() maps the file back in later.
+    #
+    # dims = d makes the process d-dimensional: X then has
+    # shape (paths, d, n_steps), and X[...,i] is (paths, d).
+    block_size = 2**22
+
+    def __init__(self, n_steps, total_t, X_0=0.0, paths=1, store=None, dims=None):
         self.n_steps = int(n_steps)
         self.T       = float(total_t)
-        self.X       = np.zeros(self.n_steps)
-        self.X[0]    = float(X_0)
+        self.paths   = int(paths)
+        self.store   = store
+        self.dims    = dims
+        if dims is not None:
+            shape = (self.paths, int(dims), self.n_steps)
+        else:
+            shape = (self.paths, self.n_steps)
+        if store is not None:
+            self.X = np.lib.format.open_memmap(store, mode='w+', dtype=float,
+                                               shape=shape, fortran_order=True)
+        elif self.paths == 1 and dims is None:
+            self.X = np.zeros(self.n_steps)
+        else:
+            self.X = np.zeros(shape, order='F')
+        self.X[...,0] = X_0
 
     def __getitem__(self, i):
         return self.X[i]
 
     def __setitem__(self, i, value):
-        self.X[i] = float(value)
+        self.X[i] = value
 
     def delta_t(self):
         return float(self.T)/float(self.n_steps)
 
+    # time of each step
+    def times(self):
+        return np.arange(self.n_steps) * self.delta_t()
+
+    # The rows of paths to work on at a time, as indices into X:
+    # everything (...) in memory, slices of rows for a store
+    def row_blocks(self):
+        if self.store is None:
+            yield Ellipsis
+            return
+        for rows in row_slices(self.paths, self.block_size // (self.X.size // self.paths)):
+            yield rows
+
+    # write any changes to a store out to its file
+    def flush(self):
+        if self.store is not None:
+            self.X.flush()
+
+# slices of at most `rows` rows covering `paths` rows
+def row_slices(paths, rows):
+    rows = max(1, int(rows))
+    return [slice(r, min(r + rows, paths)) for r in range(0, paths, rows)]
+
+def load_paths(store, mode='r'):
+    """The paths saved in a store (see Process) as a read-only
+    memory map, with no copy into memory; mode='r+' to modify them.
+    """
+
+    return np.load(store, mmap_mode=mode)
+
 class Stock(Process):
-    def __init__(self, n_steps, total_t, X_0, rate_rtn, volatility):
-        Process.__init__(self, n_steps, total_t, X_0)
+    def __init__(self, n_steps, total_t, X_0, rate_rtn, volatility, paths=1, store=None):
+        Process.__init__(self, n_steps, total_t, X_0, paths, store)
         self.mu    = rate_rtn
         self.sigma = volatility
 
 class Wiener(Process):
-    def __init__(self, n_steps, total_t):
-        Process.__init__(self, n_steps, total_t)
+    # antithetic=True draws half the paths and mirrors them,
+    # see normal_draws(); sampler='sobol' builds the paths by a
+    # Brownian bridge from scrambled Sobol points instead.
+    # rng is the Generator to draw from, see generator().
+    def __init__(self, n_steps, total_t, paths=1, antithetic=False, sampler=None,
+                 rng=None, store=None):
+        Process.__init__(self, n_steps, total_t, 0.0, paths, store)
+        self.antithetic = antithetic
+        self.sampler    = sampler
+        self.rng        = rng
+        self.setup()
+
+    # all the increments in one (paths, n_steps-1) block, or for
+    # a store in blocks of rows; the draws come in the same order
+    # either way, so a store holds the same paths as memory would
+    def setup(self):
+        dt = self.delta_t()
+        X  = self.X.reshape(self.paths, self.n_steps)
+        if self.sampler == 'sobol':
+            sobol = sobol_engine(self.n_steps-1, self.rng)
+            for rows in self.draw_blocks(self.paths):
+                Z = sobol_normals(rows.stop - rows.start, self.n_steps-1, sobol=sobol)
+                X[rows,1:] = brownian_bridge(Z, dt)
+            return
+
+        mirror = self.antithetic and self.paths > 1
+        if mirror and self.paths % 2:
+            raise ValueError("antithetic draws need an even number of paths, got %d" % self.paths)
+        half = self.paths//2 if mirror else self.paths
+        rng  = generator(self.rng)
+        for rows in self.draw_blocks(half):
+            Z = rng.normal(0, 1, (rows.stop - rows.start, self.n_steps-1))
+            np.cumsum(Z * m.sqrt(dt), axis=-1, out=Z)
+            X[rows,1:] = Z
+            if mirror:
+                # paths k and half+k are an antithetic pair
+                X[rows.start+half:rows.stop+half,1:] = -Z
+
+    def draw_blocks(self, paths):
+        if self.store is None:
+            return [slice(0, paths)]
+        return row_slices(paths, self.block_size // self.n_steps)
+
+# Drift and diffusion coefficients f(x, t) are array-native:
+# x holds the states of all paths at time t, and f returns
+# their coefficients as an array of the same shape (or a scalar
+# that broadcasts to it).  Functors declare this with a class
+# attribute vectorized = True, as DriftRate, Bgbm and
+# RisklessRate do, and are used as they are; anything else is
+# tried on an array of states, and a callable that only takes
+# one state at a time is wrapped in Pointwise.
+def coefficient(f):
+    if f is None or getattr(f, 'vectorized', False):
+        return f
+    x = np.array([1.0, 2.0])
+    try:
+        with np.errstate(all='ignore'):
+            y = np.asarray(f(x, 0.0))
+        if y.shape in ((), x.shape):
+            return f
+    except (TypeError, ValueError):
+        pass
+    return Pointwise(f)
+
+class Pointwise:
+    # array-native form of a coefficient f(x, t) that takes
+    # only scalar states, calling it once per path: correct,
+    # but only as fast as the Python loop
+    vectorized = True
+
+    def __init__(self, f):
+        self.f = f
+
+    def __call__(self, x, t):
+        if np.ndim(x) == 0:
+            return self.f(x, t)
+        y = [self.f(x_k, t) for x_k in np.ravel(x)]
+        return np.reshape(y, np.shape(x))
+
+# Lower Cholesky factors of correlation matrices, by matrix,
+# so that each is factored once however many runs use it
+cholesky_cache = {}
+
+def cholesky(corr):
+    corr = np.asarray(corr, dtype=float)
+    if corr.ndim != 2 or corr.shape[0] != corr.shape[1] or not np.allclose(corr, corr.T):
+        raise ValueError("correlation matrix must be square and symmetric")
+    key = (corr.shape, corr.tobytes())
+    if key not in cholesky_cache:
+        L = np.linalg.cholesky(corr)
+        L.flags.writeable = False
+        cholesky_cache[key] = L
+    return cholesky_cache[key]
+
+class CorrelatedWiener(Process):
+    # d Wiener processes with correlation matrix corr (d x d),
+    # X of shape (paths, d, n_steps).  Independent normals for
+    # all paths and steps are drawn in one block and correlated
+    # by the Cholesky factor L, corr = L L^T, in one matrix
+    # product, rather than in a loop over the assets.
+    def __init__(self, n_steps, total_t, corr, paths=1, rng=None):
+        self.L   = cholesky(corr)
+        self.rng = rng
+        Process.__init__(self, n_steps, total_t, 0.0, paths, None, len(self.L))
         self.setup()
 
     def setup(self):
         dt = self.delta_t()
-        for i in range(self.n_steps - 1):
-            Z = np.random.normal(0,1)
-            self.X[i+1] = self.X[i] + Z * m.sqrt(dt)
+        Z  = generator(self.rng).normal(0, 1, (self.paths * (self.n_steps-1), self.dims))
+        dW = Z.dot(self.L.T * m.sqrt(dt)).reshape(self.paths, self.n_steps-1, self.dims)
+        np.cumsum(dW, axis=1, out=dW)
+        self.X[...,1:] = dW.transpose(0, 2, 1)
+
+class Basket(Process):
+    # d correlated stocks, each a GBM with its own S_0, mu and
+    # sigma (scalars are shared by all); X is (paths, d, n_steps),
+    # and any of the schemes below, Adaptive included, evolves it
+    # with a CorrelatedWiener, one array operation per step
+    def __init__(self, n_steps, total_t, S_0, rate_rtn, volatility, paths=1):
+        S_0 = np.asarray(S_0, dtype=float)
+        Process.__init__(self, n_steps, total_t, S_0, paths, None, len(S_0))
+        self.mu    = np.broadcast_to(np.asarray(rate_rtn, dtype=float), S_0.shape)
+        self.sigma = np.broadcast_to(np.asarray(volatility, dtype=float), S_0.shape)
 
 class Euler:
+    # a and b go through coefficient(), so scalar functions
+    # work too, if slowly
     def __init__(self, stock, a, b, wiener):
         self.S = stock
-        self.a = a
-        self.b = b
+        self.a = coefficient(a)
+        self.b = coefficient(b)
         self.W = wiener
     
+    # advance all paths one time step per array operation;
+    # a and b are called with the states of every path at once
+    # (of a block of paths at a time for a store)
     def evolve(self):
         dt = self.S.delta_t()
-        t  = np.linspace(0, self.S.T, self.S.n_steps)
+        t  = self.S.times()
 
-        dW = np.zeros(self.S.n_steps)
-        for i in range(1, len(dW)):
-            dW[i] = self.W[i] - self.W[i-1]
-        
-        for i in range(self.S.n_steps - 1):
-            self.S[i+1]  = self.S[i]
-            self.S[i+1] += self.a(self.S[i], t[i]) * dt
-            self.S[i+1] += self.b(self.S[i], t[i]) * dW[i]
+        for rows in self.S.row_blocks():
+            X = self.S.X[rows]
+            W = self.W.X[rows]
+            for i in range(self.S.n_steps - 1):
+                X[...,i+1] = self.step(X[...,i], t[i], dt, W[...,i+1] - W[...,i])
+
+    # one step of length dt from states x at time t
+    def step(self, x, t, dt, dW):
+        return x + self.a(x, t) * dt + self.b(x, t) * dW
+
+class Milstein(Euler):
+    # Milstein scheme, strong order 1.0:
+    #
+    #   x' = x + a dt + b dW + b b_y (dW^2 - dt) / 2
+    #
+    # db(y, t) is the derivative of b in y; without it
+    # b_y is taken by central differences.
+    def __init__(self, stock, a, b, wiener, db=None):
+        Euler.__init__(self, stock, a, b, wiener)
+        self.db = coefficient(db)
+
+    def b_y(self, x, t):
+        if self.db is not None:
+            return self.db(x, t)
+        h = 1.0E-6 * (1 + np.abs(x))
+        return (self.b(x + h, t) - self.b(x - h, t)) / (2*h)
+
+    def step(self, x, t, dt, dW):
+        b = self.b(x, t)
+        return x + self.a(x, t) * dt + b * dW + 0.5 * b * self.b_y(x, t) * (dW**2 - dt)
+
+class SRK(Euler):
+    # Derivative-free stochastic Runge-Kutta scheme of strong
+    # order 1.0 (Platen): b b_y in the Milstein term is replaced
+    # by a difference of b at x and at the supporting value
+    #
+    #   x~ = x + a dt + b sqrt(dt).
+    def step(self, x, t, dt, dW):
+        a = self.a(x, t)
+        b = self.b(x, t)
+        sqrt_dt = m.sqrt(dt)
+        support = x + a * dt + b * sqrt_dt
+        return x + a * dt + b * dW + (self.b(support, t) - b) * (dW**2 - dt) / (2*sqrt_dt)
+
+class Adaptive:
+    # Adaptive step size control on top of any of the schemes
+    # above.  Each step of the Wiener grid is tried as one step
+    # and as two half steps, the Wiener path being refined at
+    # the midpoint by a Brownian bridge draw
+    #
+    #   W(t+h/2) = (W(t) + W(t+h))/2 + sqrt(h/4) Z,
+    #
+    # with Z correlated by L on a CorrelatedWiener.
+    #
+    # Paths where the two results differ by more than tol are
+    # halved again, recursively, up to max_depth times, the
+    # half steps already taken serving as the single steps
+    # tested against at the next level; the others keep the
+    # two-half-step result.  A step that passes costs three
+    # evaluations for two steps' worth of accuracy, so on a
+    # problem as even as GBM a uniform grid of the same cost
+    # does as well; the Wiener grid can be coarse, with steps
+    # spent only where needed, when the need is uneven.
+    # The midpoints are drawn from the Wiener process's rng.
+    def __init__(self, scheme, tol=1.0E-3, max_depth=12):
+        self.scheme    = scheme
+        self.tol       = float(tol)
+        self.max_depth = int(max_depth)
+
+    def evolve(self):
+        S  = self.scheme.S
+        dt = S.delta_t()
+        t  = S.times()
+        self.steps_taken = 0
+
+        for rows in S.row_blocks():
+            X = S.X[rows]
+            W = self.scheme.W.X[rows]
+            for i in range(S.n_steps - 1):
+                x = np.atleast_1d(X[...,i])
+                w0 = np.atleast_1d(W[...,i])
+                w1 = np.atleast_1d(W[...,i+1])
+                full = self.scheme.step(x, t[i], dt, w1 - w0)
+                self.steps_taken += len(x)
+                X[...,i+1] = self.advance(x, t[i], dt, w0, w1, full, 0).reshape(X[...,i+1].shape)
+
+    # states at t+h from x at t, given W at both ends and
+    # full, the result of one step of h
+    def advance(self, x, t, h, w0, w1, full, depth):
+        step  = self.scheme.step
+        rng   = generator(getattr(self.scheme.W, 'rng', None))
+        Z     = rng.normal(0, 1, w0.shape)
+        # a CorrelatedWiener's midpoints are correlated like its
+        # increments, or the bridge would decorrelate the assets
+        L     = getattr(self.scheme.W, 'L', None)
+        if L is not None:
+            Z = Z.dot(L.T)
+        w_mid = (w0 + w1)/2 + m.sqrt(h/4) * Z
+        x_mid = step(x, t, h/2, w_mid - w0)
+        half  = step(x_mid, t + h/2, h/2, w1 - w_mid)
+        self.steps_taken += 2 * len(x)
+
+        # a path of a d-dimensional process (a Basket) is redone
+        # as a whole if any of its components missed tol
+        redo = np.abs(full - half) > self.tol
+        if redo.ndim > 1:
+            redo = redo.any(axis=-1)
+        if depth < self.max_depth and redo.any():
+            # the first half step is the single step of the first
+            # half's test; the second half starts from where the
+            # refined first half ends, so it needs one of its own
+            x_mid = self.advance(x[redo], t, h/2, w0[redo], w_mid[redo], x_mid[redo], depth+1)
+            w_mid, w1 = w_mid[redo], w1[redo]
+            full  = step(x_mid, t + h/2, h/2, w1 - w_mid)
+            self.steps_taken += len(x_mid)
+            half[redo] = self.advance(x_mid, t + h/2, h/2, w_mid, w1, full, depth+1)
+        return half
 
 class DriftRate:
+    vectorized = True
+
     def __init__(self, stock):
         self.mu = stock.mu
 
@@ -64,6 +433,8 @@ class DriftRate:
         return self.mu * x
 
 class Bgbm:
+    vectorized = True
+
     def __init__(self, stock):
         self.sigma = stock.sigma
 
@@ -71,6 +442,8 @@ class Bgbm:
         return self.sigma * x
 
 class RisklessRate:
+    vectorized = True
+
     def __init__(self, interest):
         self.r = interest
 
@@ -92,6 +465,393 @@ class RNBM(Euler):
         b = Bgbm(stock)
         Euler.__init__(self, stock, a, b, wiener)
 
+class Exact:
+    # Geometric Brownian motion from its exact solution
+    #
+    #   S(t) = S_0 exp( (mu - sigma^2/2) t + sigma W(t) ),
+    #
+    # so there is no discretization error and the grid only
+    # needs the times at which S is wanted.  Takes interest
+    # in place of stock.mu for the risk-neutral process.
+    def __init__(self, stock, wiener, interest=None):
+        self.S = stock
+        self.W = wiener
+        if interest is None:
+            self.mu = stock.mu
+        else:
+            self.mu = interest
+
+    def evolve(self):
+        # one value per asset for a Basket, along its axis
+        sigma = np.asarray(self.S.sigma)[...,np.newaxis]
+        mu    = np.asarray(self.mu)[...,np.newaxis]
+        t     = self.S.times()
+        for rows in self.S.row_blocks():
+            log_S = (mu - sigma**2/2) * t + sigma * self.W.X[rows]
+            self.S.X[rows] = self.S.X[rows][...,:1] * np.exp(log_S)
+
+def sample_gbm(S_0, mu, sigma, times, paths=1, antithetic=False, sampler=None,
+               rng=None):
+    """Exact GBM prices at the observation times, shape (paths, len(times)).
+
+    Each interval between observations gets one normal draw in log
+    space, so a European option needs a single draw per path, with
+    no discretization bias.  sampler='sobol' uses scrambled Sobol
+    points instead, through a Brownian bridge when the times are
+    equally spaced.  rng is the Generator to draw from.
+    """
+
+    times = np.atleast_1d(np.asarray(times, dtype=float))
+    dt    = np.diff(np.concatenate(([0.0], times)))
+    if sampler == 'sobol':
+        Z = sobol_normals(int(paths), len(times), rng)
+        if np.allclose(dt, dt[0]):
+            W = brownian_bridge(Z, dt[0])
+            return S_0 * np.exp((mu - sigma**2/2) * times + sigma * W)
+    else:
+        Z = normal_draws((int(paths), len(times)), antithetic, rng)
+    log_S = np.cumsum((mu - sigma**2/2) * dt + sigma * np.sqrt(dt) * Z, axis=-1)
+    return S_0 * np.exp(log_S)
+
+
+class GBMPaths:
+    # Functor simulating a block of GBM paths (RNBM paths if an
+    # interest rate is given); returns the (paths, n_steps) prices,
+    # drawn from rng if one is given
+    def __init__(self, n_steps, total_t, S_0, mu, sigma, interest=None,
+                 antithetic=False, sampler=None):
+        self.n_steps    = n_steps
+        self.T          = total_t
+        self.S_0        = S_0
+        self.mu         = mu
+        self.sigma      = sigma
+        self.interest   = interest
+        self.antithetic = antithetic
+        self.sampler    = sampler
+
+    def __call__(self, paths, rng=None):
+        S = Stock(self.n_steps, self.T, self.S_0, self.mu, self.sigma, paths)
+        W = Wiener(self.n_steps, self.T, paths, self.antithetic, self.sampler, rng)
+        if self.interest is None:
+            G = GBM(S, W)
+        else:
+            G = RNBM(S, W, self.interest)
+        G.evolve()
+        return S.X
+
+class ExactPaths:
+    # Functor like GBMPaths, but sampling the exact solution
+    # at the observation times only; pass the interest rate
+    # as mu for risk-neutral paths
+    def __init__(self, times, S_0, mu, sigma, antithetic=False, sampler=None):
+        self.times      = times
+        self.S_0        = S_0
+        self.mu         = mu
+        self.sigma      = sigma
+        self.antithetic = antithetic
+        self.sampler    = sampler
+
+    def __call__(self, paths, rng=None):
+        return sample_gbm(self.S_0, self.mu, self.sigma, self.times, paths,
+                          self.antithetic, self.sampler, rng)
+
+class BasketPaths:
+    # Functor simulating a block of Basket paths by their exact
+    # solution (see Exact), correlated by corr, risk-neutral with
+    # drift interest if one is given; returns (paths, d, n_steps)
+    def __init__(self, n_steps, total_t, S_0, mu, sigma, corr, interest=None):
+        self.n_steps  = n_steps
+        self.T        = total_t
+        self.S_0      = S_0
+        self.mu       = mu
+        self.sigma    = sigma
+        self.corr     = np.asarray(corr, dtype=float)
+        self.interest = interest
+
+    def __call__(self, paths, rng=None):
+        S = Basket(self.n_steps, self.T, self.S_0, self.mu, self.sigma, paths)
+        W = CorrelatedWiener(self.n_steps, self.T, self.corr, paths, rng)
+        Exact(S, W, self.interest).evolve()
+        return S.X
+
+class EuropeanPayoff:
+    # discounted payoff of a European option on the final
+    # price of each path in a (paths, n_steps) block
+    def __init__(self, strike, is_put=False, discount=1.0):
+        self.strike   = float(strike)
+        self.is_put   = is_put
+        self.discount = float(discount)
+
+    def __call__(self, X):
+        if self.is_put:
+            value = self.strike - X[...,-1]
+        else:
+            value = X[...,-1] - self.strike
+        return self.discount * np.maximum(value, 0)
+
+class BasketPayoff(EuropeanPayoff):
+    # discounted payoff of a European option on the weighted sum
+    # of the final prices in a (paths, d, n_steps) Basket block;
+    # weights (1, -1) give a spread option
+    def __init__(self, weights, strike, is_put=False, discount=1.0):
+        EuropeanPayoff.__init__(self, strike, is_put, discount)
+        self.weights = np.asarray(weights, dtype=float)
+
+    def __call__(self, X):
+        basket = X[...,-1].dot(self.weights)
+        return EuropeanPayoff.__call__(self, basket[...,np.newaxis])
+
+class RunningStats:
+    # Running mean and variance over chunks of samples, merging
+    # each chunk in with the parallel form of Welford's update
+    # (Chan et al.), so memory does not grow with the sample count.
+    # reservoir > 0 also keeps a uniform random sample of that size
+    # (reservoir sampling) for approximate quantiles, drawing the
+    # slots from rng.
+    def __init__(self, reservoir=0, rng=None):
+        self.n      = 0
+        self.mean   = 0.0
+        self.M2     = 0.0
+        self.sample = np.zeros(int(reservoir))
+        self.rng    = rng
+
+    def update(self, values):
+        values = np.ravel(values)
+        k = len(values)
+        if k == 0:
+            return
+
+        chunk_mean = values.mean()
+        chunk_M2   = ((values - chunk_mean)**2).sum()
+        delta      = chunk_mean - self.mean
+        n          = self.n + k
+        self.mean += delta * k / n
+        self.M2   += chunk_M2 + delta**2 * self.n * k / n
+
+        size = len(self.sample)
+        if size:
+            # the first `size` samples fill the reservoir, after
+            # which sample number s (0-based) replaces a random
+            # slot with probability size/(s+1)
+            filled = min(self.n, size)
+            fill   = min(size - filled, k)
+            self.sample[filled:filled+fill] = values[:fill]
+            seen   = self.n + fill + np.arange(k - fill)
+            slots  = (generator(self.rng).uniform(0, 1, k - fill) * (seen + 1)).astype(int)
+            keep   = slots < size
+            self.sample[slots[keep]] = values[fill:][keep]
+
+        self.n = n
+
+    def variance(self):
+        if self.n < 2:
+            return np.nan
+        return self.M2 / (self.n - 1)
+
+    def std_error(self):
+        return m.sqrt(self.variance() / self.n)
+
+    # q in [0, 1], from the reservoir sample
+    def quantile(self, q):
+        return np.percentile(self.sample[:min(self.n, len(self.sample))], 100*np.asarray(q))
+
+# sizes of the blocks of at most chunk_size that make up
+# `paths` paths; antithetic models need whole pairs in every block
+def block_sizes(model, paths, chunk_size):
+    paths      = int(paths)
+    chunk_size = int(chunk_size)
+    if getattr(model, 'antithetic', False):
+        chunk_size += chunk_size % 2
+        paths      += paths % 2
+    sizes = [chunk_size] * (paths // chunk_size)
+    if paths % chunk_size:
+        sizes.append(paths % chunk_size)
+    return sizes
+
+# n independent seed sequences spawned from seed; child k depends
+# only on seed and k, so block k gets the same random stream
+# however the blocks are shared out
+def spawn_seeds(seed, n):
+    return np.random.SeedSequence(seed).spawn(n)
+
+def path_chunks(model, paths, chunk_size=10000, seed=None):
+    """Yield the paths simulated by model in blocks of at most
+    chunk_size, so that only one block is held at a time.
+
+    model is called with the number of paths in the block
+    and returns them as a (block, n_steps) array, as GBMPaths does.
+    With a seed, block k is drawn from a Generator of its own,
+    spawned from the seed (model called as model(block, rng)),
+    giving the same paths as simulate() with that seed.
+    """
+
+    sizes = block_sizes(model, paths, chunk_size)
+    if seed is None:
+        for block in sizes:
+            yield model(block)
+        return
+
+    for block, child in zip(sizes, spawn_seeds(seed, len(sizes))):
+        yield model(block, np.random.default_rng(child))
+
+def estimate(payoff, model, paths, chunk_size=10000, target_se=None, reservoir=0,
+             seed=None):
+    """Monte Carlo estimate of E[payoff] over at most `paths` paths.
+
+    Paths are generated in chunks by path_chunks() and only the
+    payoffs are kept, in a RunningStats, so memory stays bounded by
+    chunk_size whatever the number of paths.  With target_se given,
+    the run stops early once the standard error falls below it.
+    A seed makes the run reproducible, see path_chunks().
+
+    Returns the RunningStats; its mean, std_error() and quantile()
+    hold the results.
+    """
+
+    rng = None
+    if seed is not None:
+        # the stream after those of the blocks
+        n   = len(block_sizes(model, paths, chunk_size))
+        rng = np.random.default_rng(spawn_seeds(seed, n + 1)[-1])
+
+    stats = RunningStats(reservoir, rng)
+    for X in path_chunks(model, paths, chunk_size, seed):
+        Y = payoff(X)
+        if getattr(model, 'antithetic', False):
+            # the pair means are the independent samples
+            half = len(Y)//2
+            Y = (Y[:half] + Y[half:]) / 2
+        stats.update(Y)
+        if target_se is not None and stats.n > 1 and stats.std_error() <= target_se:
+            break
+    return stats
+
+# one block of simulate(), at module level so that
+# worker processes can unpickle it
+def run_block(task):
+    model, payoff, block, seed = task
+    X = model(block, np.random.default_rng(seed))
+    if payoff is not None:
+        return payoff(X)
+    return X
+
+def simulate(model, paths, seed=None, block_size=10000, workers=1, payoff=None):
+    """Simulate `paths` paths with model, in blocks spread over
+    a pool of worker processes.
+
+    Block k is drawn from its own Generator, spawned from seed
+    by a SeedSequence, and the blocks are put back together in
+    order, so the result depends only on seed and block_size:
+    it is bit for bit the same for any number of workers, and
+    the same as path_chunks() with that seed.  seed=None takes
+    fresh entropy from the OS.
+
+    model is called as model(block, rng), as GBMPaths is.  With
+    a payoff only payoff(X) is returned from each block, which
+    saves sending whole paths back from the workers.  With
+    workers > 1, model and payoff have to pickle (module level
+    classes such as GBMPaths and EuropeanPayoff do, lambdas do not).
+    """
+
+    sizes = block_sizes(model, paths, block_size)
+    tasks = [(model, payoff, block, child)
+             for block, child in zip(sizes, spawn_seeds(seed, len(sizes)))]
+
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = pool.map(run_block, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [run_block(task) for task in tasks]
+    return np.concatenate(results)
+
+
+
+def qmc_estimate(payoff, model, paths=1024, replicates=16, seed=None):
+    """Randomized quasi-Monte Carlo estimate of E[payoff].
+
+    model should draw from scrambled Sobol points (sampler='sobol');
+    each of the replicates is an independent scrambling of `paths`
+    points, and the spread of their means gives the standard error,
+    which the paths within one replicate cannot.  With a seed each
+    replicate takes its scrambling from a stream spawned from it.
+
+    Returns (estimate, std_error).
+    """
+
+    if seed is None:
+        means = [payoff(model(paths)).mean() for k in range(replicates)]
+    else:
+        means = [payoff(model(paths, np.random.default_rng(child))).mean()
+                 for child in spawn_seeds(seed, replicates)]
+    means = np.array(means)
+    return means.mean(), means.std(ddof=1) / m.sqrt(replicates)
+
+def antithetic_estimate(Y):
+    """Estimate from payoffs Y of an antithetic run, where Y[k] and
+    Y[h+k] come from mirrored paths (h = len(Y)/2).
+
+    Returns (estimate, std_error, factor), factor being the
+    variance reduction over the same number of independent paths.
+    """
+
+    half  = len(Y)//2
+    pairs = (Y[:half] + Y[half:2*half]) / 2
+    estimate  = pairs.mean()
+    std_error = pairs.std(ddof=1) / m.sqrt(half)
+    factor    = Y.var(ddof=1) / (2 * pairs.var(ddof=1))
+    return estimate, std_error, factor
+
+def control_variate(Y, X, mean_X):
+    """Control variate estimate of E[Y] from samples Y and X,
+    where E[X] = mean_X is known:
+
+      Y - beta (X - mean_X),    beta = cov(Y, X) / var(X).
+
+    Returns (estimate, std_error, factor), factor = var(Y)/var(adjusted),
+    the variance reduction over the plain estimate.
+    """
+
+    Y = np.ravel(Y)
+    X = np.ravel(X)
+    cov  = np.cov(Y, X)
+    beta = cov[0,1] / cov[1,1]
+    adjusted  = Y - beta * (X - mean_X)
+    estimate  = adjusted.mean()
+    std_error = adjusted.std(ddof=1) / m.sqrt(len(Y))
+    factor    = cov[0,0] / adjusted.var(ddof=1)
+    return estimate, std_error, factor
+
+class BlackScholesControl:
+    # Control variate from a closed-form European option of
+    # implied_vol.py (EuropeanCall or EuropeanPut): the control is
+    # its discounted payoff on the final price of each path, whose
+    # expectation is option.valuation() as long as the paths are
+    # risk-neutral (drift interest - dividend) up to time2mature.
+    def __init__(self, option):
+        self.option = option
+        is_put      = option.is_put
+        discount    = m.exp(-option.interest * option.time2mature)
+        self.payoff = EuropeanPayoff(option.strike, is_put, discount)
+
+    def __call__(self, X):
+        return self.payoff(X)
+
+    def mean(self):
+        return self.option.valuation()
+
+def estimate_with_control(payoff, control, X):
+    """Control variate estimate of E[payoff] on the paths X,
+    with a BlackScholesControl (or any functor with a mean()).
+    Returns (estimate, std_error, factor), see control_variate().
+    """
+
+    return control_variate(payoff(X), control(X), control.mean())
+
+
 
 if __name__ == '__main__':
     import matplotlib.pyplot as plt
@@ -100,11 +860,21 @@ if __name__ == '__main__':
     visual   = False
     total_t  = 1
     n_steps  = 10000
+    paths    = 1
     rate     = 0.35
     sigma    = 0.3
     S_zero   = 5
     interest = 0.12
     riskless = False
+    chunk    = None
+    target   = None
+    exact    = False
+    anti     = False
+    sampler  = None
+    seed     = None
+    workers  = 1
+    basket   = None
+    rho      = 0.5
     
     while len(sys.argv) > 1:
         option = sys.argv[1]
@@ -115,6 +885,33 @@ if __name__ == '__main__':
         elif option == '-n':
             n_steps = int(sys.argv[1])
             del sys.argv[1]
+        elif option == '-paths':
+            paths = int(sys.argv[1])
+            del sys.argv[1]
+        elif option == '-seed':
+            seed = int(sys.argv[1])
+            del sys.argv[1]
+        elif option == '-workers':
+            workers = int(sys.argv[1])
+            del sys.argv[1]
+        elif option == '-basket':
+            basket = int(sys.argv[1])
+            del sys.argv[1]
+        elif option == '-rho':
+            rho = float(sys.argv[1])
+            del sys.argv[1]
+        elif option == '-sobol':
+            sampler = 'sobol'
+        elif option == '-anti':
+            anti = True
+        elif option == '-exact':
+            exact = True
+        elif option == '-chunk':
+            chunk = int(sys.argv[1])
+            del sys.argv[1]
+        elif option == '-se':
+            target = float(sys.argv[1])
+            del sys.argv[1]
         elif option == '-t':
             total_t = float(sys.argv[1])
             del sys.argv[1]
@@ -132,27 +929,79 @@ if __name__ == '__main__':
             interest = float(sys.argv[1])
             del sys.argv[1]
         else:
-            print sys.argv[0], ': Invalid option', option
+            print(sys.argv[0], ': Invalid option', option)
             sys.exit(1)
     
         
 
-    S = Stock(n_steps, total_t, S_zero, rate, sigma)
-    W = Wiener(n_steps, total_t)
+    if basket is not None:
+        # at-the-money call on an equally weighted basket of
+        # identical names, each pair correlated by rho
+        corr   = (1 - rho) * np.eye(basket) + rho
+        model  = BasketPaths(n_steps, total_t, [S_zero] * basket, rate, sigma, corr,
+                             interest if riskless else None)
+        payoff = BasketPayoff(np.ones(basket) / basket, S_zero, False,
+                              m.exp(-interest * total_t) if riskless else 1.0)
+        stats  = estimate(payoff, model, paths, chunk or 10000, target, 0, seed)
+        print("Call on a basket of %d names (rho = %f) over %d paths: %f, std error %f"
+              % (basket, rho, stats.n, stats.mean, stats.std_error()))
+        sys.exit(0)
+
+    if chunk is not None or workers > 1:
+        # stream the paths, keeping only the final prices
+        if exact:
+            # only the final date is needed
+            model = ExactPaths([total_t], S_zero, interest if riskless else rate, sigma,
+                               anti, sampler)
+        elif riskless:
+            model = GBMPaths(n_steps, total_t, S_zero, rate, sigma, interest, anti, sampler)
+        else:
+            model = GBMPaths(n_steps, total_t, S_zero, rate, sigma, None, anti, sampler)
+        if workers > 1:
+            # one final price per path from the pool, in the same
+            # order as a serial run with this seed
+            S_T = simulate(model, paths, seed, chunk or 10000, workers,
+                           EuropeanPayoff(0.0))
+            print("Final stock price over %d paths on %d workers: mean %f, std error %f"
+                  % (len(S_T), workers, S_T.mean(), S_T.std(ddof=1) / m.sqrt(len(S_T))))
+            sys.exit(0)
+        stats = estimate(lambda X: X[...,-1], model, paths, chunk, target, 10000, seed)
+        # antithetic samples are pair means
+        print("Final stock price over %d paths: mean %f, std error %f"
+              % (stats.n * (2 if anti else 1), stats.mean, stats.std_error()))
+        print("5%%, 50%%, 95%% quantiles: %f, %f, %f" % tuple(stats.quantile([0.05, 0.5, 0.95])))
+        sys.exit(0)
+
+    S = Stock(n_steps, total_t, S_zero, rate, sigma, paths)
+    W = Wiener(n_steps, total_t, paths, anti, sampler,
+               None if seed is None else np.random.default_rng(seed))
 
-    if riskless:
+    if exact and riskless:
+        G = Exact(S, W, interest)
+    elif exact:
+        G = Exact(S, W)
+    elif riskless:
         G = RNBM(S, W, interest)
     else:
         G = GBM(S, W)
     
     G.evolve()
 
+    if paths > 1 and anti:
+        mean, std_error, factor = antithetic_estimate(S.X[:,-1])
+        print("Final stock price over %d antithetic paths: mean %f, std error %f"
+              % (paths, mean, std_error))
+        print("Variance reduction factor %f" % factor)
+    elif paths > 1:
+        S_T = S.X[:,-1]
+        print("Final stock price over %d paths: mean %f, std error %f"
+              % (paths, S_T.mean(), S_T.std(ddof=1) / m.sqrt(paths)))
     
     if visual:
         t = np.linspace(0, total_t, n_steps)
 
-        plt.plot(t, S[:], 'b', label='Stock Price')
-        plt.plot(t, W[:], 'r', label='Brownian Motion')
+        plt.plot(t, S.X.T, 'b', label='Stock Price')
+        plt.plot(t, W.X.T, 'r', label='Brownian Motion')
         plt.legend()
         
         plt.show()
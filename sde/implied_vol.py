@@ -3,10 +3,105 @@
 # implied_vol.py
 # A program for calculating the implied volatility.
 
+import collections
 import math as m
-from scipy.stats import norm
+import numpy as np
+from timeit import default_timer
+from scipy.special import ndtr
 import matplotlib.pyplot as plt
-import newton
+import binomial
+from binomial import black_scholes
+
+def implied_vols(V, S, K, tau, r, q=0.0, is_put=False, tol=1.0E-10, max_iter=50,
+                 guess=None):
+    """Black-Scholes implied volatilities of a whole array of option
+    prices V at once, the other arguments broadcasting as for
+    black_scholes().
+
+    Each price is reduced to its time value w, which by put-call
+    parity is the price of the out-of-the-money option at that
+    strike, and the total volatility s = sigma sqrt(tau) solving
+
+      OTM(s) = w
+
+    is found from the Corrado-Miller approximation by Halley steps
+    (Newton's with the curvature term, vega' = vega d1 d2 / s).
+    Each price keeps a bracket [lo, hi] on s from the signs of
+    the errors so far, and a step that leaves it is replaced by
+    bisection (or by doubling s before any upper bound is known).
+    Only the prices not yet converged to within tol in sigma are
+    carried into the next iteration.
+
+    Prices outside the no-arbitrage bounds (time value not in
+    (0, min(S e^{-q tau}, K e^{-r tau}))) get nan, as do any not
+    converged within max_iter iterations.
+
+    guess, if given, holds starting volatilities (say the last
+    solution for each quote), used in place of Corrado-Miller
+    wherever it is finite and positive; near the root a warm
+    start needs only one or two steps.
+    """
+
+    if guess is None:
+        guess = np.nan
+    V, S, K, tau, r, q, is_put, guess = np.broadcast_arrays(V, S, K, tau, r, q, is_put, guess)
+    guess = np.asarray(guess, dtype=float).ravel()
+    V, S, K, tau, r, q = [np.asarray(x, dtype=float).ravel() for x in (V, S, K, tau, r, q)]
+    shape = is_put.shape
+    is_put = is_put.ravel().astype(bool)
+
+    S_q   = S * np.exp(-q * tau)
+    K_r   = K * np.exp(-r * tau)
+    w     = V - np.where(is_put, np.maximum(K_r - S_q, 0), np.maximum(S_q - K_r, 0))
+    sigma = np.full(V.shape, np.nan)
+    with np.errstate(all='ignore'):
+        ok = (w > 0) & (w < np.minimum(S_q, K_r)) & (tau > 0)
+    idx = np.flatnonzero(ok)
+
+    S_q, K_r, w   = S_q[idx], K_r[idx], w[idx]
+    sqrt_tau      = np.sqrt(tau[idx])
+    x             = np.log(S_q / K_r)
+    theta         = np.where(x > 0, -1.0, 1.0)      # OTM call +1, OTM put -1
+    half_gap      = np.abs(S_q - K_r) / 2
+
+    # Corrado-Miller: with c the call price at that strike,
+    # s ~ sqrt(2 pi)/(S+K) (c - (S-K)/2 + sqrt((c - (S-K)/2)^2 - (S-K)^2/pi))
+    a  = w + half_gap
+    s  = m.sqrt(2*m.pi) / (S_q + K_r) * (a + np.sqrt(np.maximum(a**2 - 4*half_gap**2/m.pi, 0)))
+    s  = np.maximum(s, 1.0E-3)
+    with np.errstate(invalid='ignore'):
+        warm = guess[idx] > 0
+    s  = np.where(warm, guess[idx] * sqrt_tau, s)
+    lo = np.zeros(len(idx))
+    hi = np.full(len(idx), np.inf)
+
+    with np.errstate(all='ignore'):
+        for n in range(max_iter):
+            if len(idx) == 0:
+                break
+            d1 = x/s + s/2
+            d2 = d1 - s
+            f  = theta * (S_q * ndtr(theta*d1) - K_r * ndtr(theta*d2)) - w
+            vega = S_q * np.exp(-d1**2 / 2) / m.sqrt(2*m.pi)
+
+            hi = np.where(f > 0, s, hi)
+            lo = np.where(f > 0, lo, s)
+
+            ratio  = f / vega
+            halley = 1 - ratio * d1 * d2 / (2*s)
+            step   = np.where(halley > 0.5, ratio / halley, ratio)
+            new    = s - step
+            bad    = ~((new >= lo) & (new <= hi))
+            new    = np.where(bad, np.where(np.isinf(hi), 2*s, (lo + hi)/2), new)
+
+            done = (np.abs(new - s) <= tol * sqrt_tau) | (f == 0)
+            sigma[idx[done]] = new[done] / sqrt_tau[done]
+
+            keep = ~done
+            idx, S_q, K_r, w, sqrt_tau = idx[keep], S_q[keep], K_r[keep], w[keep], sqrt_tau[keep]
+            x, theta, s, lo, hi = x[keep], theta[keep], new[keep], lo[keep], hi[keep]
+
+    return sigma.reshape(shape)
 
 class Stock:
     def __init__(self, S, sigma, delta):
@@ -21,44 +116,33 @@ class EuropeanOption:
         self.time2mature = float(tau)
         self.interest    = float(r)
 
-    def parameters(self):
-        d1  = self.interest - self.underlying.dividend
-        d1 += self.underlying.sigma**2 / 2
-        d1 *= self.time2mature
-        d1 += m.log(self.underlying.spot/self.strike)
-        d1 /= self.underlying.sigma * m.sqrt(self.time2mature)
-
-        d2 = d1 - self.underlying.sigma * m.sqrt(self.time2mature)
-
-        return d1, d2
-
     # to be overridden in subclasses
     def valuation(self):
         value = None
         return value
+
+    def vega(self):
+        return black_scholes(self.underlying.spot, self.strike, self.time2mature,
+                             self.interest, self.underlying.dividend,
+                             self.underlying.sigma, vega=True)[1]
     
-    def implied_volatility(self, data=[], plot=False):
-        # take a K, V pair from the data
-        # guess a sigma
-        # create a stock with that sigma
-        # create an option with that stock and K
-        # do a valuation of the option
-        # compare the valuation with V: f := V - valuation
-        # apply SecantX() to minimize f
-        
-        # so f takes sigma as a variable, but has K as parameter
-        # f must create the option as part of its routine
-        # it also has tau and r as parameters, in order to create the option
-        
-        sigma0  = self.underlying.sigma
-        sigma1  = self.underlying.sigma + 5
-        results = []
-        for i in range(len(data)):
-            K, V         = data[i]
-            self.strike  = K
-            f            = Comparison(self, V)
-            sigma, n, f1 = newton.SecantX(f, sigma0, sigma1)
-            results.append((K, sigma))
+    def implied_volatility(self, data=[], plot=False, american=False):
+        # the implied volatilities of all the (K, V) pairs
+        # of the data in one call to implied_vols(), for
+        # options like this one but for the strike; with
+        # american=True the prices are taken to be those of
+        # American options, see american_implied_vols()
+        Ks      = [K for K, V in data]
+        Vs      = [V for K, V in data]
+        if american:
+            if self.underlying.dividend:
+                raise ValueError("American implied volatilities need a zero dividend yield")
+            sigmas = american_implied_vols(Vs, self.underlying.spot, Ks, self.time2mature,
+                                           self.interest, self.is_put)
+        else:
+            sigmas = implied_vols(Vs, self.underlying.spot, Ks, self.time2mature,
+                                  self.interest, self.underlying.dividend, self.is_put)
+        results = [(K, float(sigma)) for K, sigma in zip(Ks, sigmas)]
         
         if plot:
             Ks = [result[0] for result in results]
@@ -70,51 +154,286 @@ class EuropeanOption:
 
 
 class EuropeanCall(EuropeanOption):
+    is_put = False
+
     def __init__(self, stock, K, tau, r):
         EuropeanOption.__init__(self, stock, K, tau, r)
 
     def valuation(self):
-        d1, d2 = self.parameters()
-        
-        x = norm()
-        
-        s1  = x.cdf(d1)
-        s1 *= m.exp(-self.underlying.dividend*self.time2mature)
-        s1 *= self.underlying.spot
-
-        s2  = x.cdf(d2)
-        s2 *= m.exp(-self.interest*self.time2mature)
-        s2 *= self.strike
-
-        return s1 - s2
+        return black_scholes(self.underlying.spot, self.strike, self.time2mature,
+                             self.interest, self.underlying.dividend,
+                             self.underlying.sigma, False)
 
 class EuropeanPut(EuropeanOption):
+    is_put = True
+
     def __init__(self, stock, K, tau, r):
         EuropeanOption.__init__(self, stock, K, tau, r)
 
     def valuation(self):
-        d1, d2 = self.parameters()
-        
-        x = norm()
-        
-        s1  = x.cdf(-d1)
-        s1 *= m.exp(-self.underlying.dividend*self.time2mature)
-        s1 *= -self.underlying.spot
+        return black_scholes(self.underlying.spot, self.strike, self.time2mature,
+                             self.interest, self.underlying.dividend,
+                             self.underlying.sigma, True)
+
+def american_implied_vols(V, S, K, tau, r, is_put=True, steps=201, tol=1.0E-6,
+                          max_iter=10):
+    """Implied volatilities of American option prices V for the
+    strikes K, all expiring at tau, with binomial.py's tree as the
+    pricing kernel.
+
+    All the strikes still being solved are priced in one backward
+    sweep of a binomial.Chain, on a single binomial.Stock whose
+    sigma is a column of one volatility per strike.  The
+    search starts from the European implied volatility, takes a
+    Newton step with the Black-Scholes vega for slope, then
+    secant steps through the lattice prices; as the early exercise
+    premium changes little with sigma, two or three sweeps
+    usually bring the lattice price within tol of V.
+
+    The tree has no dividend yield.  Its steps levels span
+    (steps-1) periods, so it is set up with T = tau steps/(steps-1)
+    to end at tau.  Prices not above the intrinsic value, and
+    strikes not within tol after max_iter sweeps, get nan.
+    """
+
+    V, K, is_put = np.broadcast_arrays(np.asarray(V, dtype=float),
+                                       np.asarray(K, dtype=float), is_put)
+    shape  = V.shape
+    V, K   = V.ravel(), K.ravel()
+    is_put = is_put.ravel().astype(bool)
+
+    intrinsic = np.maximum(np.where(is_put, K - S, S - K), 0)
+    sigma = implied_vols(V, S, K, tau, r, 0.0, is_put)
+    # above the European bounds (a deep put) start from a
+    # typical volatility instead
+    sigma = np.where(np.isfinite(sigma), sigma, 0.3)
+    sigma[~(V > intrinsic)] = np.nan
+
+    lattice = binomial.Stock(r, 0.2, S, tau * steps / (steps - 1.0), steps, False)
+    active  = np.flatnonzero(np.isfinite(sigma))
+    last    = None
+    for n in range(max_iter):
+        if len(active) == 0:
+            break
+        s = sigma[active]
+        lattice.sigma = s[:,np.newaxis]
+        lattice.create_tree()
+        chain = binomial.Chain(K[active], lattice, is_put[active], american=True)
+        chain.create_tree()
+        f = chain.fair_price() - V[active]
+
+        # secant slope from the previous sweep where there is one
+        slope = black_scholes(S, K[active], tau, r, 0.0, s, vega=True)[1]
+        if last is not None:
+            s_prev, f_prev = last
+            with np.errstate(all='ignore'):
+                secant = (f - f_prev) / (s - s_prev)
+            slope = np.where(np.isfinite(secant) & (secant > 0), secant, slope)
+
+        new  = np.maximum(s - f / slope, s / 2)
+        done = (np.abs(f) <= tol) | (np.abs(new - s) <= tol * 1.0E-3)
+        sigma[active] = np.where(done, s, new)
+
+        keep   = ~done
+        last   = (s[keep], f[keep])
+        active = active[keep]
+
+    # strikes still unsolved after max_iter sweeps
+    sigma[active] = np.nan
+    return sigma.reshape(shape)
+
+class VolSurface:
+    # Implied volatility surface sigma(K, tau) from option quotes
+    # at several expiries, for a spot S with rates r and q.
+    #
+    # Each expiry's quotes are inverted in one implied_vols() call
+    # and kept as a slice of total variance w = sigma^2 tau against
+    # log-moneyness k = log(K/F), F = S e^{(r-q) tau} the forward,
+    # sorted in k with the slope of each interval precomputed, so
+    # w is linear between quoted strikes (and flat beyond them).
+    # Between expiries w is linear in tau at fixed k, and beyond
+    # the first and last expiry the volatility is held constant.
+    #
+    # Lookups are vectorized, a binary search (searchsorted) per
+    # point in the expiries and in the two slices around it.
+    # update() replaces the quotes of one expiry and rebuilds
+    # only that slice.
+    def __init__(self, spot, r, q=0.0):
+        self.spot     = float(spot)
+        self.r        = float(r)
+        self.q        = float(q)
+        self.slices   = {}
+        self.expiries = np.zeros(0)
+
+    def forward(self, tau):
+        return self.spot * np.exp((self.r - self.q) * tau)
+
+    # quotes V (prices) for strikes K expiring at tau; is_put
+    # may be an array of flags.  Quotes that do not invert
+    # (outside the no-arbitrage bounds) are left out, and those
+    # repeating a strike are averaged in total variance.
+    def update(self, tau, K, V, is_put=False):
+        tau   = float(tau)
+        K     = np.asarray(K, dtype=float)
+        sigma = implied_vols(V, self.spot, K, tau, self.r, self.q, is_put)
+        sigma, K = np.broadcast_arrays(sigma, K)
+        good  = np.isfinite(sigma)
+        if not good.any():
+            raise ValueError("no quote at tau = %g inverts to a volatility" % tau)
+
+        k = np.log(K[good] / self.forward(tau))
+        w = sigma[good]**2 * tau
+        # sorted in k, quotes at the same strike (a put and a call)
+        # merged into their mean variance
+        k, at = np.unique(k, return_inverse=True)
+        w     = np.bincount(at, weights=w) / np.bincount(at)
+        slope = np.zeros(len(k))
+        if len(k) > 1:
+            slope[:-1] = np.diff(w) / np.diff(k)
+        self.slices[tau] = (k, w, slope)
+        self.expiries    = np.array(sorted(self.slices))
+
+    def remove(self, tau):
+        del self.slices[float(tau)]
+        self.expiries = np.array(sorted(self.slices))
+
+    # total variance of slice tau at log-moneyness k
+    def slice_variance(self, tau, k):
+        ks, ws, slope = self.slices[tau]
+        i = np.clip(np.searchsorted(ks, k, side='right') - 1, 0, len(ks) - 1)
+        return ws[i] + slope[i] * np.clip(k - ks[i], 0, None)
+
+    def total_variance(self, K, tau):
+        if not self.slices:
+            raise ValueError("the surface has no quotes")
+        K, tau = np.broadcast_arrays(np.asarray(K, dtype=float), np.asarray(tau, dtype=float))
+        k = np.log(K / self.forward(tau))
+        T = self.expiries
+
+        # the expiries either side of each tau, clamped at the ends
+        upper = np.clip(np.searchsorted(T, tau), 0, len(T) - 1)
+        lower = np.clip(upper - 1, 0, None)
+        lower = np.where(tau >= T[upper], upper, lower)
+        w_lo  = np.zeros(k.shape)
+        w_hi  = np.zeros(k.shape)
+        for j in np.unique(np.concatenate((lower.ravel(), upper.ravel()))):
+            at = lower == j
+            w_lo[at] = self.slice_variance(T[j], k[at])
+            at = upper == j
+            w_hi[at] = self.slice_variance(T[j], k[at])
+
+        T_lo, T_hi = T[lower], T[upper]
+        inside = T_hi > T_lo
+        theta  = np.where(inside, (tau - T_lo) / np.where(inside, T_hi - T_lo, 1), 0)
+        w      = (1 - theta) * w_lo + theta * w_hi
+        # constant volatility before the first and after the last expiry
+        outside = ~inside
+        w = np.where(outside, w_lo * tau / T_lo, w)
+        return w[()]
+
+    def __call__(self, K, tau):
+        return np.sqrt(self.total_variance(K, tau) / tau)
+
+class IVStream:
+    # Implied volatilities of a set of contracts, kept up to date
+    # from a feed of quotes in which only a few prices change at a
+    # time.  Each tick re-solves only the contracts whose price
+    # changed (all of them if the spot moved), in one
+    # implied_vols() call warm-started from their last volatilities,
+    # then passes the new ones to the subscribers.
+    #
+    # tick() does all its work synchronously and returns in well
+    # under a millisecond for a chain, so it can be called straight
+    # from an event loop callback or coroutine; run() drives it
+    # from any iterable feed and run_async() from an asynchronous
+    # one (async for update in stream.run_async(feed): ...).
+    # The time taken by each of the last `window` ticks is kept
+    # for stats().
+    def __init__(self, spot, r, q=0.0, window=1000):
+        self.spot        = float(spot)
+        self.r           = float(r)
+        self.q           = float(q)
+        self.contracts   = []
+        self.index       = {}
+        self.K           = np.zeros(0)
+        self.tau         = np.zeros(0)
+        self.is_put      = np.zeros(0, dtype=bool)
+        self.V           = np.zeros(0)
+        self.sigma       = np.zeros(0)
+        self.subscribers = []
+        self.latency     = collections.deque(maxlen=window)
+
+    # a new contract, quoted from the next tick on; contract is
+    # any hashable name for it
+    def add(self, contract, K, tau, is_put=False):
+        if contract in self.index:
+            raise ValueError("contract %r is already in the stream" % (contract,))
+        self.index[contract] = len(self.contracts)
+        self.contracts.append(contract)
+        self.K      = np.append(self.K, float(K))
+        self.tau    = np.append(self.tau, float(tau))
+        self.is_put = np.append(self.is_put, bool(is_put))
+        self.V      = np.append(self.V, np.nan)
+        self.sigma  = np.append(self.sigma, np.nan)
+
+    # callback(updates, latency) is called after every tick with
+    # the {contract: sigma} that changed and the seconds it took
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def __getitem__(self, contract):
+        return self.sigma[self.index[contract]]
+
+    def tick(self, quotes, spot=None):
+        """Take the new prices {contract: V} (and spot, if it moved),
+        re-solve the volatilities that they change and publish them.
+        Returns the {contract: sigma} updates.
+        """
+
+        start = default_timer()
+        rows  = []
+        for contract, V in quotes.items():
+            i = self.index[contract]
+            if V != self.V[i]:
+                self.V[i] = V
+                rows.append(i)
+        if spot is not None and spot != self.spot:
+            self.spot = float(spot)
+            rows = np.flatnonzero(np.isfinite(self.V))
+
+        rows    = np.asarray(rows, dtype=int)
+        updates = {}
+        if len(rows):
+            sigma = implied_vols(self.V[rows], self.spot, self.K[rows], self.tau[rows],
+                                 self.r, self.q, self.is_put[rows], guess=self.sigma[rows])
+            self.sigma[rows] = sigma
+            updates = dict(zip([self.contracts[i] for i in rows], sigma))
+        latency = default_timer() - start
+        self.latency.append(latency)
 
-        s2  = x.cdf(-d2)
-        s2 *= m.exp(-self.interest*self.time2mature)
-        s2 *= self.strike
+        for callback in self.subscribers:
+            callback(updates, latency)
+        return updates
 
-        return s1 + s2
+    # tick() on each (quotes, spot) pair of the feed in turn
+    def run(self, feed):
+        for quotes, spot in feed:
+            yield self.tick(quotes, spot)
 
-class Comparison:
-    def __init__(self, option, V):
-        self.option = option
-        self.V      = V
+    # the same for a feed that is an asynchronous iterable, such
+    # as a websocket reader; the loop gets control back between
+    # ticks while the feed waits for quotes
+    async def run_async(self, feed):
+        async for quotes, spot in feed:
+            yield self.tick(quotes, spot)
 
-    def __call__(self, sigma):
-        self.option.underlying.sigma = sigma
-        return self.V - self.option.valuation()
+    # (ticks, mean, median, 99th percentile, max) of the tick
+    # latencies in seconds, over the last `window` ticks
+    def stats(self):
+        if not self.latency:
+            return 0, np.nan, np.nan, np.nan, np.nan
+        t = np.array(self.latency)
+        return len(t), t.mean(), np.median(t), np.percentile(t, 99), t.max()
 
 
 if __name__ == '__main__':    
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+
+# lsm.py
+# American options by least-squares Monte Carlo (Longstaff-Schwartz)
+# on the risk-neutral paths of gbm.py.
+
+import math as m
+import numpy as np
+import gbm
+
+class LongstaffSchwartz:
+    # American option on (paths, n_steps) risk-neutral price paths,
+    # as simulated by RNBM or by ExactPaths with mu = interest.
+    # Column 0 holds the spot and columns 1..n_steps-1 are the
+    # exercise dates, dt apart.  Going backwards from expiry, the
+    # discounted cash flows of the paths in the money at each date
+    # are regressed on a polynomial in S/K of the given degree, by
+    # one least squares solve over all those paths; the fit is the
+    # value of holding on, and paths exercise where it is below the
+    # exercise value.
+    #
+    # Called on a block of paths it returns the cash flow of each
+    # path discounted to time 0, as EuropeanPayoff does, so that
+    # gbm.estimate() gives the price and its standard error.  The
+    # regression then uses the same paths, which biases the price
+    # up a little; fit() keeps the coefficients from one set of
+    # paths to price fresh ones with, which biases it down instead.
+    def __init__(self, strike, interest, dt, is_put=True, degree=3):
+        self.strike       = float(strike)
+        self.r            = float(interest)
+        self.dt           = float(dt)
+        self.is_put       = is_put
+        self.degree       = int(degree)
+        self.coefficients = None
+
+    def exercise(self, S):
+        if self.is_put:
+            return np.maximum(self.strike - S, 0)
+        return np.maximum(S - self.strike, 0)
+
+    # regressors 1, S/K, ..., (S/K)^degree, one row per path
+    def basis(self, S):
+        return (S / self.strike)[:,np.newaxis] ** np.arange(self.degree + 1)
+
+    # discounted cash flow of each path, and the regression
+    # coefficients for each exercise date (None where there were
+    # too few paths in the money to fit); with coefficients
+    # given they are used in place of a fit
+    def cash_flows(self, X, coefficients=None):
+        X    = np.atleast_2d(X)
+        n    = X.shape[1]
+        disc = m.exp(-self.r * self.dt)
+        cash = self.exercise(X[:,-1])
+        fits = [None] * n
+
+        for i in range(n-2, 0, -1):
+            cash *= disc
+            value = self.exercise(X[:,i])
+            itm   = np.flatnonzero(value > 0)
+            if coefficients is not None:
+                beta = coefficients[i]
+            elif len(itm) > self.degree + 1:
+                beta = np.linalg.lstsq(self.basis(X[itm,i]), cash[itm], rcond=None)[0]
+            else:
+                beta = None
+            fits[i] = beta
+            if beta is None:
+                continue
+
+            hold = self.basis(X[itm,i]).dot(beta)
+            stop = itm[value[itm] > hold]
+            cash[stop] = value[stop]
+
+        return cash * disc, fits
+
+    # fit the exercise rule to the paths X; returns their cash flows
+    def fit(self, X):
+        cash, self.coefficients = self.cash_flows(X)
+        return cash
+
+    def __call__(self, X):
+        return self.cash_flows(X, self.coefficients)[0]
+
+    def price(self, X):
+        """Price and standard error on the paths X, by the fitted
+        exercise rule if fit() was called, else by one fitted to X.
+        Exercising at once is worth the intrinsic value, which
+        bounds the price from below.
+        """
+
+        Y = self(X)
+        S_0 = np.atleast_2d(X)[0,0]
+        return max(Y.mean(), self.exercise(S_0)), Y.std(ddof=1) / m.sqrt(len(Y))
+
+
+
+if __name__ == '__main__':
+    import binomial
+    import sys
+
+    n_steps  = 51
+    paths    = 100000
+    total_t  = 51/50.0
+    rate     = 0.06
+    sigma    = 0.2
+    S_zero   = 36
+    strike   = 40
+    put      = True
+    degree   = 3
+    euler    = False
+    seed     = None
+
+    while len(sys.argv) > 1:
+        option = sys.argv[1]
+        del sys.argv[1]
+
+        if option == '-n':
+            n_steps = int(sys.argv[1])
+            del sys.argv[1]
+        elif option == '-paths':
+            paths = int(sys.argv[1])
+            del sys.argv[1]
+        elif option == '-deg':
+            degree = int(sys.argv[1])
+            del sys.argv[1]
+        elif option == '-euler':
+            euler = True
+        elif option == '-seed':
+            seed = int(sys.argv[1])
+            del sys.argv[1]
+        elif option == '-c':
+            put = False
+        elif option == '-t':
+            total_t = float(sys.argv[1])
+            del sys.argv[1]
+        elif option == '-r':
+            rate = float(sys.argv[1])
+            del sys.argv[1]
+        elif option == '-sig':
+            sigma = float(sys.argv[1])
+            del sys.argv[1]
+        elif option == '-s':
+            S_zero = float(sys.argv[1])
+            del sys.argv[1]
+        elif option == '-k':
+            strike = float(sys.argv[1])
+            del sys.argv[1]
+        else:
+            print(sys.argv[0], ': Invalid option', option)
+            sys.exit(1)
+
+    # dates 0, dt, ..., (n_steps-1) dt as for gbm.Process
+    dt      = total_t / n_steps
+    horizon = (n_steps - 1) * dt
+    # exact paths by default, so that the comparison with the
+    # lattice is free of discretization bias; -euler for RNBM
+    if euler:
+        model = gbm.GBMPaths(n_steps, total_t, S_zero, rate, sigma, rate)
+    else:
+        model = gbm.ExactPaths(np.arange(n_steps) * dt, S_zero, rate, sigma)
+
+    # independent streams for the three sets of paths
+    if seed is None:
+        rngs = [None] * 3
+    else:
+        rngs = [np.random.default_rng(s) for s in gbm.spawn_seeds(seed, 3)]
+    in_rng, fit_rng, price_rng = rngs
+
+    V = LongstaffSchwartz(strike, rate, dt, put, degree)
+    in_sample, in_error = V.price(model(paths, in_rng))
+    V.fit(model(paths, fit_rng))
+    out_sample, out_error = V.price(model(paths, price_rng))
+
+    # the same horizon on the lattice, whose steps levels
+    # also span (steps-1) of its time steps
+    levels = 2000
+    B = binomial.Stock(rate, sigma, S_zero, horizon * levels / (levels - 1.0), levels, False)
+    B.create_tree()
+    A = binomial.American(strike, B, put)
+    A.create_tree()
+
+    print("American %s with %d exercise dates to t = %f over %d paths"
+          % ("put" if put else "call", n_steps - 1, horizon, paths))
+    print("\tr = %f\n\tsigma = %f\n\tS_0 = %f\n\tK = %f" % (rate, sigma, S_zero, strike))
+    print("LSM price, in sample      = %f (std error %f)" % (in_sample, in_error))
+    print("LSM price, fresh paths    = %f (std error %f)" % (out_sample, out_error))
+    print("Binomial price, %d levels = %f" % (levels, A.fair_price()))
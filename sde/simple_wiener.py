@@ -9,6 +9,7 @@ import matplotlib.pyplot as plt
 
 n_steps = 100
 delta_t = 0.01
+seed    = None
 
 while len(sys.argv) > 1:
     option = sys.argv[1]
@@ -20,17 +21,23 @@ while len(sys.argv) > 1:
     elif option == '-dt':
         delta_t = float(sys.argv[1])
         del sys.argv[1]
+    elif option == '-seed':
+        seed = int(sys.argv[1])
+        del sys.argv[1]
     else:
-        print sys.argv[0], ': Invalid option', option
+        print(sys.argv[0], ': Invalid option', option)
         sys.exit(1)
 
+# a fixed -seed replays the same path
+rng = np.random.default_rng(seed)
+
 t    = np.linspace(0, n_steps * delta_t, n_steps)
 W    = np.zeros(n_steps)
 W[0] = 0.0
 
 for i in range(n_steps-1):
     dt     = delta_t
-    Z      = np.random.normal(0,1)
+    Z      = rng.normal(0,1)
     W[i+1] = W[i] + Z * m.sqrt(dt)
 
 plt.plot(t, W)